@@ -1,8 +1,24 @@
 import os
+import sys
+import json
+import time
 import random
+import hashlib
+import contextlib
 from PIL import Image, ImageDraw, ImageFont
 import xml.etree.ElementTree as ET
 
+# ストローク描画（src/data/strokes.py）。notebookでは __file__ がないため作業ディレクトリから探す
+try:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    sys.path.append(os.path.join(os.getcwd(), "..", "src", "data"))
+try:
+    from strokes import generate_stroke_formula, rasterize_strokes
+except ImportError:
+    # フォント描画だけなら strokes.py がなくても使える
+    generate_stroke_formula = rasterize_strokes = None
+
 # 数式をランダム生成（例: "12+34=", "7-2="）
 def generate_random_formula(min_digits=1, max_digits=2):
     def random_number():
@@ -419,6 +435,107 @@ def generate_horizontal_positions_dynamic(char_sizes, available_width, margin, m
     
     return x_positions
 
+# データセットの状態ファイル（次の画像番号と各シャードの範囲を保存）
+STATE_FILE = "dataset_state.json"
+
+def write_json_atomic(path, data):
+    """一時ファイルに書いてから置き換える（途中で中断しても壊れない）"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+@contextlib.contextmanager
+def dataset_state_lock(output_dir, timeout=60):
+    """
+    状態ファイルを読み書きする間の排他ロック（O_EXCL でロックファイルを作る）
+    同時に生成している別のシャードの変更を上書きしないようにする
+    """
+    lock_path = os.path.join(output_dir, STATE_FILE + ".lock")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"ロックを取得できません（残っている場合は削除してください）: {lock_path}")
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+def shard_manifest_path(sets_dir, shard_name):
+    return os.path.join(sets_dir, "shards", f"{shard_name}.jsonl")
+
+def read_shard_manifest(path):
+    """シャードのマニフェスト（1行1サンプルのJSON）を読み込む"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 中断時に書きかけだった行は無視する
+                continue
+    return records
+
+def load_dataset_state(output_dir, sets_dir):
+    """
+    データセットの状態を読み込む
+
+    状態ファイルがなく train.txt だけがある（以前の形式の）データセットは
+    legacy シャードとして取り込み、続きの番号から追加できるようにする
+    """
+    state_path = os.path.join(output_dir, STATE_FILE)
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    state = {"next_index": 0, "shards": {}}
+    train_path = os.path.join(sets_dir, "train.txt")
+    if os.path.exists(train_path):
+        with open(train_path) as f:
+            image_ids = [line.strip() for line in f if line.strip()]
+        if image_ids:
+            with open(shard_manifest_path(sets_dir, "legacy"), "w", encoding="utf-8") as f:
+                for image_id in image_ids:
+                    f.write(json.dumps({"image_id": image_id}) + "\n")
+            indices = [int(image_id.rsplit("_", 1)[-1]) for image_id in image_ids
+                       if image_id.rsplit("_", 1)[-1].isdigit()]
+            state["next_index"] = max(indices) + 1 if indices else len(image_ids)
+            state["shards"]["legacy"] = {"start": 0, "count": len(image_ids), "done": True}
+    return state
+
+def merge_shard_lists(sets_dir, state):
+    """完了したシャードの画像IDをまとめて train.txt を置き換える"""
+    image_ids = []
+    shards = sorted(state["shards"].items(), key=lambda item: item[1]["start"])
+    for shard_name, shard in shards:
+        if not shard["done"]:
+            continue
+        for record in read_shard_manifest(shard_manifest_path(sets_dir, shard_name)):
+            if not record.get("duplicate"):
+                image_ids.append(record["image_id"])
+
+    train_path = os.path.join(sets_dir, "train.txt")
+    tmp_path = train_path + ".tmp"
+    image_ids = list(dict.fromkeys(image_ids))
+    with open(tmp_path, "w") as f:
+        for image_id in image_ids:
+            f.write(image_id + "\n")
+    os.replace(tmp_path, train_path)
+    return len(image_ids)
+
+def sample_hash(formula, font_name, size):
+    """数式＋フォント＋サイズから重複判定用のハッシュを作る"""
+    return hashlib.sha1(f"{formula}|{font_name}|{size}".encode("utf-8")).hexdigest()
+
 # データセット一括生成（ランダムレイアウト対応版）
 def create_voc_dataset(
     output_dir="dataset",
@@ -430,15 +547,23 @@ def create_voc_dataset(
     font_counts=None,
     random_font_size=False,
     font_size_range=(80, 150),
-    random_layout=False
+    random_layout=False,
+    stroke_ratio=0.0,
+    stroke_width_range=(3, 7),
+    append=False,
+    shard_name=None,
+    dedup=False
 ):
+    if stroke_ratio > 0 and generate_stroke_formula is None:
+        raise ImportError("stroke_ratio を使うには src/data/strokes.py が必要です")
+
     # ディレクトリ準備
     img_dir = os.path.join(output_dir, "JPEGImages")
     ann_dir = os.path.join(output_dir, "Annotations")
     sets_dir = os.path.join(output_dir, "ImageSets", "Main")
     os.makedirs(img_dir, exist_ok=True)
     os.makedirs(ann_dir, exist_ok=True)
-    os.makedirs(sets_dir, exist_ok=True)
+    os.makedirs(os.path.join(sets_dir, "shards"), exist_ok=True)
 
     # フォントの準備
     if font_paths is None:
@@ -449,8 +574,6 @@ def create_voc_dataset(
     base_fonts = load_fonts(font_paths, font_size)
     print(f"📝 使用可能なフォント数: {len(base_fonts)}")
 
-    image_ids = []
-
     if formula_list is not None:
         formulas = formula_list
         actual_samples = len(formulas)
@@ -458,6 +581,94 @@ def create_voc_dataset(
         formulas = [generate_random_formula() for _ in range(num_samples)]
         actual_samples = num_samples
 
+    # 状態の読み込みとシャードの番号範囲の確保
+    # （ロック中に最新の状態を読み直し、このシャードの分と next_index だけを変更する）
+    state_path = os.path.join(output_dir, STATE_FILE)
+    with dataset_state_lock(output_dir):
+        if append:
+            state = load_dataset_state(output_dir, sets_dir)
+        else:
+            # append=False の場合は新しく作り直す
+            state = {"next_index": 0, "shards": {}}
+        if shard_name is None:
+            # 中断したシャードがあればその続きから、なければ新しいシャード
+            unfinished = sorted(
+                (shard["start"], name) for name, shard in state["shards"].items() if not shard["done"]
+            )
+            if unfinished:
+                shard_name = unfinished[0][1]
+            else:
+                number = len(state["shards"])
+                while f"shard_{number:03}" in state["shards"]:
+                    number += 1
+                shard_name = f"shard_{number:03}"
+        manifest_path = shard_manifest_path(sets_dir, shard_name)
+
+        shard = state["shards"].get(shard_name)
+        if shard is not None and shard["done"]:
+            print(f"✅ シャード {shard_name} は生成済みです")
+            merge_shard_lists(sets_dir, state)
+            return
+
+        new_shard = shard is None
+        if new_shard:
+            # 新しいシャードの番号範囲を確保して保存
+            shard = {"start": state["next_index"], "count": actual_samples, "done": False}
+            state["shards"][shard_name] = shard
+            state["next_index"] += actual_samples
+            open(manifest_path, "w").close()
+            write_json_atomic(state_path, state)
+
+    if new_shard:
+        completed = set()
+        print(f"🧩 シャード {shard_name} を開始: image_{shard['start']:03} 〜 {actual_samples}枚")
+    else:
+        # 中断したシャードの続きから（生成済みのサンプルは飛ばす）
+        completed = {record["image_id"] for record in read_shard_manifest(manifest_path)}
+        if shard["count"] != actual_samples:
+            print(f"⚠️ シャード {shard_name} の枚数({shard['count']})に合わせます")
+            actual_samples = shard["count"]
+            if formula_list is None:
+                formulas = [generate_random_formula() for _ in range(actual_samples)]
+            else:
+                actual_samples = min(actual_samples, len(formulas))
+        print(f"🔁 シャード {shard_name} を再開: {len(completed)}/{actual_samples}枚 生成済み")
+
+    # 重複判定用のハッシュ（全シャード分）
+    seen_hashes = set()
+    if dedup:
+        for name in state["shards"]:
+            for record in read_shard_manifest(shard_manifest_path(sets_dir, name)):
+                if "hash" in record:
+                    seen_hashes.add(record["hash"])
+
+    def resolve_duplicate(formula, font_name, size):
+        """重複していれば数式を選び直す（選び直せない場合は None）"""
+        key = sample_hash(formula, font_name, size)
+        retries = 0
+        while key in seen_hashes:
+            if formula_list is not None or retries >= 10:
+                return None, key
+            formula = generate_random_formula()
+            key = sample_hash(formula, font_name, size)
+            retries += 1
+        return formula, key
+
+    written_count = 0
+
+    def record_sample(record):
+        """サンプルの完了をマニフェストに記録（書き込み後に完了扱い）"""
+        nonlocal written_count
+        # 中断されてもファイルを開いたままにしないよう、1件ごとに開いて閉じる
+        with open(manifest_path, "a", encoding="utf-8") as manifest:
+            manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        if "hash" in record:
+            seen_hashes.add(record["hash"])
+        if not record.get("duplicate"):
+            written_count += 1
+
     font_assignment = create_font_assignment(
         num_fonts=len(base_fonts),
         total_samples=actual_samples,
@@ -465,11 +676,38 @@ def create_voc_dataset(
     )
     
     font_usage_count = {i: 0 for i in range(len(base_fonts))}
+    stroke_count = 0
+
+    # ランダムフォントサイズの範囲（より柔軟なサイズ制限）
+    max_safe_size = min(font_size_range[1], int(image_size[1] * 0.8))  # 画像高さの80%まで
+    min_safe_size = max(font_size_range[0], 30)
 
     for i in range(actual_samples):
         formula = formulas[i]
-        image_id = f"image_{i:03}"
-        image_ids.append(image_id)
+        image_id = f"image_{shard['start'] + i:03}"
+        if image_id in completed:
+            continue
+
+        if stroke_ratio > 0 and random.random() < stroke_ratio:
+            # ストローク（手書き風）で描画
+            line_width = random.randint(*stroke_width_range)
+            record = {"image_id": image_id, "formula": formula, "font": "strokes", "size": line_width}
+            if dedup:
+                formula, record["hash"] = resolve_duplicate(formula, "strokes", line_width)
+                if formula is None:
+                    record_sample({"image_id": image_id, "duplicate": True})
+                    continue
+                record["formula"] = formula
+
+            char_height = random.randint(int(image_size[1] * 0.3), int(image_size[1] * 0.6))
+            strokes, bboxes, labels = generate_stroke_formula(formula, image_size, char_height, line_width)
+            img = rasterize_strokes(strokes, image_size, image_size, line_width).convert("RGB")
+            stroke_count += 1
+
+            img.save(os.path.join(img_dir, f"{image_id}.jpg"))
+            save_voc_annotation(image_id, image_size, bboxes, labels, ann_dir)
+            record_sample(record)
+            continue
 
         font_index = font_assignment[i]
         base_font_path = font_paths[font_index] if font_index < len(font_paths) else "default"
@@ -477,12 +715,17 @@ def create_voc_dataset(
 
         # フォントサイズを決定（制限を緩和）
         if random_font_size:
-            # より柔軟なサイズ制限に変更
-            max_safe_size = min(font_size_range[1], int(image_size[1] * 0.8))  # 画像高さの80%まで
-            min_safe_size = max(font_size_range[0], 30)
             current_font_size = random.randint(min_safe_size, max_safe_size)
         else:
             current_font_size = min(font_size, int(image_size[1] * 0.6))  # 制限を緩和
+
+        record = {"image_id": image_id, "formula": formula, "font": base_font_path, "size": current_font_size}
+        if dedup:
+            formula, record["hash"] = resolve_duplicate(formula, base_font_path, current_font_size)
+            if formula is None:
+                record_sample({"image_id": image_id, "duplicate": True})
+                continue
+            record["formula"] = formula
         
         # フォントを作成
         try:
@@ -544,24 +787,33 @@ def create_voc_dataset(
         # 保存
         img.save(os.path.join(img_dir, f"{image_id}.jpg"))
         save_voc_annotation(image_id, image_size, bboxes, labels, ann_dir)
-
-    # ImageSets/Main/train.txt を保存
-    with open(os.path.join(sets_dir, "train.txt"), "w") as f:
-        for image_id in image_ids:
-            f.write(image_id + "\n")
+        record_sample(record)
+
+    # シャードを完了にして ImageSets/Main/train.txt を作り直す
+    # （ロック中に最新の状態を読み直し、このシャードの分だけを変更する）
+    with dataset_state_lock(output_dir):
+        state = load_dataset_state(output_dir, sets_dir)
+        shard["done"] = True
+        state["shards"][shard_name] = shard
+        state["next_index"] = max(state["next_index"], shard["start"] + shard["count"])
+        write_json_atomic(state_path, state)
+        total_images = merge_shard_lists(sets_dir, state)
 
     # 統計表示
     print("\n📊 フォント使用統計:")
     for i, count in font_usage_count.items():
         font_name = font_paths[i] if i < len(font_paths) else "デフォルト"
-        percentage = (count / actual_samples) * 100
+        percentage = (count / max(1, written_count)) * 100
         print(f"  フォント{i+1} ({font_name}): {count}回使用 ({percentage:.1f}%)")
 
     if formula_list is not None:
-        print(f"✅ 指定された{actual_samples}個の数式でデータ生成が完了しました。保存先: {output_dir}")
+        print(f"✅ 指定された{actual_samples}個の数式のうち{written_count}枚のデータ生成が完了しました。保存先: {output_dir}")
     else:
-        print(f"✅ ランダム生成で{actual_samples}枚のデータ生成が完了しました。保存先: {output_dir}")
+        print(f"✅ ランダム生成で{written_count}枚のデータ生成が完了しました。保存先: {output_dir}")
+    print(f"🧩 シャード {shard_name}: image_{shard['start']:03} 〜 （train.txt 合計 {total_images}枚）")
     print(f"🎨 使用したフォント数: {len(base_fonts)}")
+    if stroke_ratio > 0:
+        print(f"✍️ ストローク描画: {stroke_count}枚")
     
     if random_font_size:
         print(f"📏 フォントサイズ範囲: {min_safe_size}-{max_safe_size}")
@@ -581,6 +833,15 @@ def create_voc_dataset(
 # random_font_size: フォントサイズをランダムにするか
 # font_size_range: ランダムフォントサイズの範囲 (最小, 最大)
 # random_layout: ランダムレイアウトを使用するか
+# stroke_ratio: ストローク（手書き風）で描画するサンプルの割合（0〜1）
+# stroke_width_range: ストローク描画時の線の太さの範囲 (最小, 最大)
+# append: 既存のデータセットに追加するか（Falseの場合は image_000 から作り直す）
+# shard_name: シャード名（Noneの場合は shard_000, shard_001, ... と自動で付ける）
+#             中断した場合は append=True で再実行すると続きから生成する
+#             （shard_name を省略すると未完了のシャードのうち最も古いものを再開する）
+#             別々の shard_name を指定すれば複数のシャードを同時に生成できる
+#             （shard_name を省略した再開は、そのシャードを生成中のプロセスがないときだけ行うこと）
+# dedup: 数式＋フォント＋サイズが同じサンプルを生成しないようにするか
 # output_dirとnum_samplesは必須引数
 
 # 実行
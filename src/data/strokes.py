@@ -0,0 +1,171 @@
+import json
+import math
+import random
+from PIL import Image, ImageDraw
+
+# ストローク（ペンの軌跡）の形式:
+#   strokes = [[[x, y], [x, y], ...], ...]   （1本のストロークは点のリスト）
+# JSONでは上記のリスト、または {"width": 800, "height": 200, "strokes": [...]} を受け付ける
+
+# ストロークを読み込む
+def parse_strokes(data):
+    """
+    Args:
+        data: JSON文字列/バイト列、またはデコード済みのリスト・辞書
+
+    Returns:
+        strokes: ストロークのリスト
+        canvas_size: キャンバスサイズ (width, height)（指定がない場合は None）
+    """
+    if isinstance(data, (str, bytes, bytearray)):
+        data = json.loads(data)
+
+    canvas_size = None
+    if isinstance(data, dict):
+        if "width" in data and "height" in data:
+            canvas_size = (data["width"], data["height"])
+        data = data["strokes"]
+
+    strokes = []
+    for stroke in data:
+        points = [(float(point[0]), float(point[1])) for point in stroke]
+        if points:
+            strokes.append(points)
+    return strokes, canvas_size
+
+def stroke_bounds(strokes):
+    """全ストロークの外接矩形 (left, top, right, bottom)。点がない場合は None"""
+    xs = [x for stroke in strokes for x, _ in stroke]
+    ys = [y for stroke in strokes for _, y in stroke]
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+# ストロークを画像に描画する
+def rasterize_strokes(strokes, canvas_size, output_size=(300, 300), line_width=3, region=None):
+    """
+    キャンバス座標のストロークを output_size の白背景・黒線のグレースケール画像に直接描画する
+
+    Args:
+        strokes: ストロークのリスト
+        canvas_size: キャンバスサイズ (width, height)
+        output_size: 出力画像サイズ (width, height)
+        line_width: 出力画像上での線の太さ（ピクセル）
+        region: 描画するキャンバス上の範囲 (left, top, right, bottom)。Noneの場合はキャンバス全体
+
+    Returns:
+        image: "L" モードの画像
+    """
+    if region is None:
+        region = (0, 0, canvas_size[0], canvas_size[1])
+    left, top, right, bottom = region
+    sx = output_size[0] / max(right - left, 1e-6)
+    sy = output_size[1] / max(bottom - top, 1e-6)
+
+    image = Image.new("L", output_size, 255)
+    draw = ImageDraw.Draw(image)
+    radius = line_width / 2
+
+    for stroke in strokes:
+        points = [((x - left) * sx, (y - top) * sy) for x, y in stroke]
+        if not points:
+            continue
+        if len(points) > 1:
+            draw.line(points, fill=0, width=line_width, joint="curve")
+        # 始点・終点を丸める（1点だけのストロークは点として描く）
+        for x, y in (points[0], points[-1]):
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=0)
+
+    return image
+
+# 文字ごとのストロークの雛形（0〜1の単位正方形、yは下向き）
+def _ellipse(cx, cy, rx, ry, num_points=16):
+    return [
+        (cx + rx * math.sin(2 * math.pi * i / num_points), cy - ry * math.cos(2 * math.pi * i / num_points))
+        for i in range(num_points + 1)
+    ]
+
+CHAR_STROKES = {
+    '0': [_ellipse(0.5, 0.5, 0.4, 0.5)],
+    '1': [[(0.3, 0.2), (0.55, 0.0), (0.55, 1.0)]],
+    '2': [[(0.1, 0.25), (0.3, 0.02), (0.7, 0.02), (0.9, 0.25), (0.85, 0.45), (0.1, 1.0), (0.9, 1.0)]],
+    '3': [[(0.1, 0.1), (0.5, 0.0), (0.85, 0.2), (0.5, 0.48), (0.9, 0.75), (0.5, 1.0), (0.1, 0.9)]],
+    '4': [[(0.7, 1.0), (0.7, 0.0), (0.05, 0.7), (0.95, 0.7)]],
+    '5': [[(0.85, 0.0), (0.2, 0.0), (0.15, 0.45), (0.6, 0.4), (0.9, 0.7), (0.6, 1.0), (0.1, 0.9)]],
+    '6': [[(0.8, 0.05), (0.4, 0.1), (0.15, 0.5), (0.2, 0.9), (0.5, 1.0), (0.85, 0.8), (0.8, 0.55), (0.5, 0.45), (0.2, 0.6)]],
+    '7': [[(0.1, 0.0), (0.9, 0.0), (0.4, 1.0)]],
+    '8': [[(0.5, 0.5), (0.15, 0.25), (0.5, 0.0), (0.85, 0.25), (0.5, 0.5), (0.1, 0.75), (0.5, 1.0), (0.9, 0.75), (0.5, 0.5)]],
+    '9': [[(0.85, 0.35), (0.5, 0.5), (0.15, 0.3), (0.5, 0.0), (0.85, 0.2), (0.85, 0.35), (0.7, 1.0)]],
+    '+': [[(0.5, 0.1), (0.5, 0.9)], [(0.1, 0.5), (0.9, 0.5)]],
+    '-': [[(0.1, 0.5), (0.9, 0.5)]],
+    '*': [[(0.5, 0.1), (0.5, 0.9)], [(0.15, 0.3), (0.85, 0.7)], [(0.85, 0.3), (0.15, 0.7)]],
+    '/': [[(0.8, 0.0), (0.2, 1.0)]],
+    '=': [[(0.1, 0.3), (0.9, 0.3)], [(0.1, 0.7), (0.9, 0.7)]],
+}
+
+# 記号は数字より小さく、縦方向の中央に置く
+OPERATOR_SCALE = 0.6
+
+# 数式を手書き風のストロークとして生成
+def generate_stroke_formula(formula, image_size, char_height, line_width=5, jitter=0.04, min_spacing=10):
+    """
+    Args:
+        formula: 数式文字列
+        image_size: 画像サイズ (width, height)
+        char_height: 数字の高さ（ピクセル）
+        line_width: 線の太さ（ピクセル）
+        jitter: 点ごとの揺らぎ（文字サイズに対する割合）
+        min_spacing: 文字間の最小間隔
+
+    Returns:
+        strokes: 全文字のストロークのリスト
+        bboxes: 描画した文字ごとの [xmin, ymin, xmax, ymax]
+        labels: 描画した文字のリスト
+    """
+    strokes = []
+    bboxes = []
+    labels = []
+
+    margin = max(10, line_width * 2)
+    char_height = min(char_height, image_size[1] - 2 * margin)
+    char_width = char_height * 0.6
+    x = margin + random.randint(0, max(0, min_spacing * 2))
+    y_center = image_size[1] / 2
+    slant = random.uniform(-0.15, 0.15)  # 文字の傾き
+
+    for char in formula:
+        if char not in CHAR_STROKES:
+            continue
+
+        scale = OPERATOR_SCALE if not char.isdigit() else 1.0
+        w = char_width * scale
+        h = char_height * scale
+        if x + w > image_size[0] - margin:
+            break  # 右端に達したら終了
+        y = y_center - h / 2 + random.uniform(-0.1, 0.1) * char_height
+
+        char_strokes = []
+        for template in CHAR_STROKES[char]:
+            points = []
+            for u, v in template:
+                u += random.gauss(0, jitter) + slant * (0.5 - v)
+                v += random.gauss(0, jitter)
+                px = min(max(x + u * w, line_width), image_size[0] - line_width)
+                py = min(max(y + v * h, line_width), image_size[1] - line_width)
+                points.append((px, py))
+            char_strokes.append(points)
+
+        left, top, right, bottom = stroke_bounds(char_strokes)
+        pad = line_width / 2
+        bboxes.append([
+            int(max(0, left - pad)),
+            int(max(0, top - pad)),
+            int(min(image_size[0], math.ceil(right + pad))),
+            int(min(image_size[1], math.ceil(bottom + pad))),
+        ])
+        labels.append(char)
+        strokes.extend(char_strokes)
+
+        x += w + min_spacing + random.randint(0, min_spacing * 2)
+
+    return strokes, bboxes, labels
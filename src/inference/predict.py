@@ -1,25 +1,37 @@
 import torch
-import torchvision
-from torchvision import transforms
 from PIL import Image, ImageDraw, ImageFont
 import matplotlib.pyplot as plt
+import io
 import os
 import sys
+import json
+import time
+import bisect
+import random
+import threading
+import contextlib
+import numpy as np
+from fractions import Fraction
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from torchvision.ops import batched_nms
 
-model.eval()
-transform = transforms.Compose([
-    transforms.Resize((300, 300)),
-    transforms.ToTensor(),
-])
-
-image_path = "" # ここに予測したい画像のパスを指定
-orig_image = Image.open(image_path).convert("RGB")
-input_tensor = transform(orig_image).unsqueeze(0).to(device)
-
-with torch.no_grad():
-    outputs = model(input_tensor)
-
-output=outputs[0]
+# ストローク描画は src/data/strokes.py をデータセット生成と共用する
+# （notebookでは __file__ がないため、環境変数 STROKES_DIR か作業ディレクトリからの相対パスで探す）
+try:
+    _strokes_dirs = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")]
+except NameError:
+    _strokes_dirs = [os.path.join(os.getcwd(), "..", "src", "data"), os.path.join(os.getcwd(), "src", "data")]
+if os.environ.get("STROKES_DIR"):
+    _strokes_dirs.insert(0, os.environ["STROKES_DIR"])
+for _strokes_dir in _strokes_dirs:
+    if os.path.exists(os.path.join(_strokes_dir, "strokes.py")) and _strokes_dir not in sys.path:
+        sys.path.append(_strokes_dir)
+        break
+try:
+    from strokes import parse_strokes, stroke_bounds, rasterize_strokes
+except ImportError:
+    # 画像からの推論はストローク描画がなくても使える
+    parse_strokes = stroke_bounds = rasterize_strokes = None
 
 label_map = {
     1: '0', 2: '1', 3: '2', 4: '3', 5: '4',
@@ -27,13 +39,826 @@ label_map = {
     11: '+', 12: '-', 13: '*', 14: '/', 15: '='
 }
 
-# ====== 7. 描画準備 ======
-draw_image = orig_image.copy()
-draw = ImageDraw.Draw(draw_image)
+# ====== 推論の計測 ======
+# 秒単位のレイテンシ用バケット
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+DETECTION_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class InferenceMetrics:
+    """
+    推論の各段階の所要時間や件数をヒストグラム・カウンタとして集計する
+    enabled=False の場合は何も記録しない（計測処理のオーバーヘッドはほぼない）
+
+    Args:
+        enabled: 計測を行うか
+        prefix: メトリクス名の接頭辞
+        profile_rate: torch.profiler でトレースを取るリクエストの割合（0〜1）
+        profile_dir: トレース（Chrome trace形式）の保存先
+    """
+    def __init__(self, enabled=False, prefix="formula_inference", profile_rate=0.0, profile_dir="profiles"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self._profiling = False
+        self._lock = threading.Lock()
+        self._types = {}
+        self._values = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """ヒストグラムに値を1つ追加"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            self._types[name] = ("histogram", buckets)
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = {"buckets": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+            hist["buckets"][index] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def inc(self, name, value=1, **labels):
+        """カウンタを増やす"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._types[name] = ("counter", None)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ゲージ（現在値）を設定"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._types[name] = ("gauge", None)
+            self._values[key] = value
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name):
+        start = time.perf_counter()
+        if self._profiling:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self.observe("stage_seconds", time.perf_counter() - start, stage=name)
+
+    def stage(self, name):
+        """with文で囲んだ区間の所要時間を stage ラベル付きで記録"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed_stage(name)
+
+    @contextlib.contextmanager
+    def _profile(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+                yield
+        finally:
+            with self._lock:
+                self._profiling = False
+        path = os.path.join(self.profile_dir, f"trace_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{random.getrandbits(32):08x}.json")
+        prof.export_chrome_trace(path)
+        self.inc("profiles_total")
+
+    def profile(self):
+        """profile_rate の割合でリクエスト全体の torch.profiler トレースを取る"""
+        if not self.enabled or random.random() >= self.profile_rate:
+            return contextlib.nullcontext()
+        # 同時に複数のプロファイラは開始できないため、確認と設定をまとめて行う
+        with self._lock:
+            if self._profiling:
+                return contextlib.nullcontext()
+            self._profiling = True
+        return self._profile()
+
+    def record_rss(self):
+        """プロセスの常駐メモリ（RSS）をゲージに記録"""
+        if not self.enabled:
+            return
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            import resource
+            # Linux以外では最大RSS（macOSはバイト、それ以外はKB）
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            rss *= 1 if sys.platform == "darwin" else 1024
+        self.set("rss_bytes", rss)
+
+    def reset(self):
+        with self._lock:
+            self._types.clear()
+            self._values.clear()
+
+    def snapshot(self):
+        """JSONに変換できる形で現在の値を返す"""
+        with self._lock:
+            snapshot = {}
+            for (name, labels), value in self._values.items():
+                kind, buckets = self._types[name]
+                entry = {"labels": dict(labels)}
+                if kind == "histogram":
+                    entry.update(
+                        buckets=dict(zip([str(b) for b in buckets] + ["+Inf"], value["buckets"])),
+                        sum=value["sum"],
+                        count=value["count"],
+                    )
+                else:
+                    entry["value"] = value
+                snapshot.setdefault(f"{self.prefix}_{name}", {"type": kind, "values": []})["values"].append(entry)
+            return snapshot
+
+    def to_prometheus(self):
+        """Prometheusのテキスト形式で出力"""
+        def format_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                kind, buckets = self._types[name]
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full_name} {kind}")
+                for (key_name, labels), value in sorted(self._values.items()):
+                    if key_name != name:
+                        continue
+                    if kind != "histogram":
+                        lines.append(f"{full_name}{format_labels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ["+Inf"], value["buckets"]):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {value['sum']}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+# 推論関数が使う計測（有効にする場合は metrics.enabled = True）
+metrics = InferenceMetrics()
+
+# SSD内部の後処理（NMSを含む）を "nms" として計測できるようにする
+def instrument_model(model):
+    """
+    model.postprocess_detections を計測付きの関数で包む
+    （インスタンスに関数を持たせるため、torch.save でモデルを保存する前には使わないこと）
+    """
+    if getattr(model, "_metrics_instrumented", False):
+        return model
+    original = model.postprocess_detections
+
+    def postprocess_detections(*args, **kwargs):
+        with metrics.stage("nms"):
+            return original(*args, **kwargs)
+
+    model.postprocess_detections = postprocess_detections
+    model._metrics_instrumented = True
+    return model
+
+# メトリクスをHTTPで公開する（/metrics: Prometheus形式、/metrics.json: JSON）
+# 既定ではローカルからのみ接続できる（外部に公開する場合は host="0.0.0.0" などを指定）
+def serve_metrics(port=9100, host="127.0.0.1"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.to_prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# 画像を読み込む（パス・バイト列・ファイルオブジェクトに対応）
+def load_image(source, target_size=(300, 300)):
+    """
+    JPEGはdraftモードで target_size に近い縮小率のままデコードする
+    （フル解像度の展開を避けてデコード時間とメモリを削減）
+
+    Args:
+        source: 画像のパス、bytes/bytearray/memoryview、またはファイルオブジェクト
+        target_size: モデルへの入力サイズ (width, height)
+
+    Returns:
+        image: RGB画像
+        orig_size: デコード前の元画像サイズ (width, height)
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with metrics.stage("open"):
+        image = Image.open(source)
+        orig_size = image.size
+        # JPEG以外では何もしない
+        image.draft("RGB", target_size)
+    with metrics.stage("convert"):
+        image = image.convert("RGB")
+    return image, orig_size
+
+# 外接矩形に余白を付け、画像と同じ縦横比の切り出し範囲にする
+def fit_region(bounds, image_size, padding=0.1):
+    """
+    Args:
+        bounds: インクの外接矩形 (left, top, right, bottom)
+        image_size: 画像サイズ (width, height)
+        padding: 外接矩形の長辺に対する余白の割合
+
+    Returns:
+        region: 切り出し範囲 (left, top, right, bottom)（画像内に収まる整数座標）
+    """
+    left, top, right, bottom = bounds
+    width, height = image_size
+    pad = max(right - left, bottom - top) * padding
+    crop_w = right - left + 2 * pad
+    crop_h = bottom - top + 2 * pad
+
+    # 元画像の縦横比に合わせて短い方を広げる
+    if crop_w * height > crop_h * width:
+        crop_h = crop_w * height / width
+    else:
+        crop_w = crop_h * width / height
+    crop_w = max(1, min(width, int(round(crop_w))))
+    crop_h = max(1, min(height, int(round(crop_h))))
+
+    # 中心を保ったまま画像内に収める
+    x0 = int((left + right - crop_w) // 2)
+    y0 = int((top + bottom - crop_h) // 2)
+    x0 = min(max(x0, 0), width - crop_w)
+    y0 = min(max(y0, 0), height - crop_h)
+
+    return x0, y0, x0 + crop_w, y0 + crop_h
+
+# 文字（インク）部分を切り出す
+def crop_to_ink(image, threshold=128, padding=0.1, min_ink_ratio=0.0005):
+    """
+    二値化してインクの外接矩形を求め、余白を付けて切り出す
+    切り出す範囲は元画像と同じ縦横比に広げる（リサイズ時の歪みを学習時と揃える）
+
+    Args:
+        image: RGB画像
+        threshold: これより暗い画素をインクとみなす（0〜255）
+        padding: 外接矩形の長辺に対する余白の割合
+        min_ink_ratio: インク画素の割合がこれ未満なら空の入力とみなす
+
+    Returns:
+        cropped: 切り出した画像（空の入力の場合は None）
+        offset: 切り出し位置 (left, top)（空の入力の場合は None）
+    """
+    ink = np.asarray(image.convert("L")) < threshold
+    if ink.mean() < min_ink_ratio:
+        return None, None
+
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    left, right = cols[0], cols[-1] + 1
+    top, bottom = rows[0], rows[-1] + 1
+
+    x0, y0, x1, y1 = fit_region((left, top, right, bottom), image.size, padding)
+    return image.crop((x0, y0, x1, y1)), (x0, y0)
+
+# インク部分をフル解像度から切り出して読み込む
+def load_ink_crop(source, target_size=(300, 300), threshold=128, padding=0.1, min_ink_ratio=0.0005):
+    """
+    縮小デコードした画像でインクの範囲を求め、その範囲が target_size 以上の解像度になる
+    縮小率でデコードし直してから切り出す
+    （load_image の後に crop_to_ink を使うと、大きな写真に小さく書かれた数式は
+     切り出し後に target_size より小さくなり、拡大されて解像度が失われる）
+
+    Args:
+        source: 画像のパス、bytes/bytearray/memoryview、またはファイルオブジェクト
+        target_size: モデルへの入力サイズ (width, height)
+        threshold, padding, min_ink_ratio: crop_to_ink と同じ
+
+    Returns:
+        cropped: 切り出した画像（空の入力の場合は None）
+        region: 元画像の座標での切り出し範囲 (left, top, right, bottom)（空の入力の場合は None）
+    """
+    # デコードし直せるようにファイルオブジェクトはバイト列として読んでおく
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+    elif hasattr(source, "read"):
+        data = source.read()
+    else:
+        data = None
+
+    def open_image():
+        return Image.open(io.BytesIO(data) if data is not None else source)
+
+    with metrics.stage("open"):
+        image = open_image()
+        orig_w, orig_h = image.size
+        # JPEG以外では何もしない（フル解像度のまま）
+        image.draft("RGB", target_size)
+    with metrics.stage("convert"):
+        preview = image.convert("RGB")
+
+    with metrics.stage("crop"):
+        cropped, offset = crop_to_ink(preview, threshold, padding, min_ink_ratio)
+        if cropped is None:
+            return None, None
+
+        # プレビューの座標 → 元画像の座標
+        sx = orig_w / preview.width
+        sy = orig_h / preview.height
+        x0 = int(offset[0] * sx)
+        y0 = int(offset[1] * sy)
+        x1 = min(orig_w, int(round((offset[0] + cropped.width) * sx)))
+        y1 = min(orig_h, int(round((offset[1] + cropped.height) * sy)))
+        region = (x0, y0, x1, y1)
+
+        # 切り出し範囲が target_size 以上になる縮小率
+        draft_size = (
+            -(-target_size[0] * orig_w // (x1 - x0)),
+            -(-target_size[1] * orig_h // (y1 - y0)),
+        )
+        if draft_size[0] <= preview.width and draft_size[1] <= preview.height:
+            return cropped, region
+
+    with metrics.stage("open"):
+        image = open_image()
+        image.draft("RGB", draft_size)
+    with metrics.stage("convert"):
+        image = image.convert("RGB")
+    with metrics.stage("crop"):
+        dx = image.width / orig_w
+        dy = image.height / orig_h
+        cropped = image.crop((
+            int(x0 * dx), int(y0 * dy),
+            min(image.width, int(round(x1 * dx))), min(image.height, int(round(y1 * dy))),
+        ))
+    return cropped, region
+
+# 画像をまとめてモデル入力用のテンソルに変換
+def preprocess_batch(images, input_size=(300, 300), out=None):
+    """
+    uint8のままリサイズし、確保済みのバッチテンソルへ直接floatで書き込む
+    （transforms.Resize + ToTensor と同じ結果）
+
+    Args:
+        images: RGB画像のリスト
+        input_size: モデルへの入力サイズ (width, height)
+        out: 書き込み先のテンソル (N, 3, height, width)。Noneの場合は新しく確保する
+             （画像数より行数が多い場合は先頭の len(images) 行だけを使う）
+
+    Returns:
+        batch: (len(images), 3, height, width) のfloat32テンソル（0〜1）
+    """
+    width, height = input_size
+    if out is None:
+        out = torch.empty((len(images), 3, height, width), dtype=torch.float32)
+    out = out[:len(images)]
+    staging = torch.empty((height, width, 3), dtype=torch.uint8)
+    staging_np = staging.numpy()
+
+    for i, image in enumerate(images):
+        if image.size != (width, height):
+            image = image.resize((width, height), Image.BILINEAR)
+        staging_np[...] = image
+        # uint8 → float の変換はコピーと同時に1回だけ行う
+        out[i].copy_(staging.permute(2, 0, 1))
+
+    return out.div_(255)
+
+# ストロークをまとめてモデル入力用のテンソルに描画
+def strokes_to_tensor(stroke_batch, canvas_sizes, input_size=(300, 300), line_width=3, crop=True, out=None):
+    """
+    PNGへのエンコード・デコードを経由せず、ストロークを直接バッチテンソルへ描画する
+
+    Args:
+        stroke_batch: 画像ごとのストロークのリスト（parse_strokes の戻り値）
+        canvas_sizes: 画像ごとのキャンバスサイズ (width, height) のリスト
+                      （None の場合はストロークの外接矩形に余白を付けた範囲をキャンバスとみなす）
+        input_size: モデルへの入力サイズ (width, height)
+        line_width: 入力テンソル上での線の太さ（ピクセル）
+        crop: ストロークの外接矩形付近だけを描画するか（crop_to_ink と同じ範囲の決め方）
+        out: 書き込み先のテンソル (N, 3, height, width)。Noneの場合は新しく確保する
+             （ストローク数より行数が多い場合は先頭の len(stroke_batch) 行だけを使う）
+
+    Returns:
+        batch: (len(stroke_batch), 3, height, width) のfloat32テンソル（0〜1）
+        regions: 画像ごとに描画したキャンバス上の範囲 (left, top, right, bottom)
+    """
+    if rasterize_strokes is None:
+        raise ImportError("src/data/strokes.py が見つかりません（環境変数 STROKES_DIR で場所を指定してください）")
+
+    width, height = input_size
+    if out is None:
+        out = torch.empty((len(stroke_batch), 3, height, width), dtype=torch.float32)
+    out = out[:len(stroke_batch)]
+    staging = torch.empty((height, width), dtype=torch.uint8)
+    staging_np = staging.numpy()
+
+    regions = []
+    for i, (strokes, canvas_size) in enumerate(zip(stroke_batch, canvas_sizes)):
+        bounds = stroke_bounds(strokes)
+        if canvas_size is None:
+            if bounds is None:
+                canvas_size = input_size
+            else:
+                left, top, right, bottom = bounds
+                pad = max(right - left, bottom - top) * 0.1 + line_width
+                canvas_size = (int(right + pad) + 1, int(bottom + pad) + 1)
+        if crop and bounds is not None:
+            region = fit_region(bounds, canvas_size)
+        else:
+            region = (0, 0, canvas_size[0], canvas_size[1])
+        regions.append(region)
+
+        staging_np[...] = rasterize_strokes(strokes, canvas_size, input_size, line_width, region)
+        out[i].copy_(staging.expand(3, height, width))
+
+    return out.div_(255), regions
+
+# 検出結果をバッチ単位で後処理する
+def postprocess_detections(outputs, orig_sizes, score_threshold=0.5, iou_threshold=0.5,
+                           input_size=(300, 300), label_map=label_map, offsets=None):
+    """
+    しきい値処理・座標の拡大・クラス別重複除去・左から右への並べ替えを
+    バッチ全体に対してテンソル演算でまとめて行う
+
+    Args:
+        outputs: モデルの出力（画像ごとの {"boxes", "labels", "scores"} のリスト）
+        orig_sizes: 元画像サイズ (width, height) のリスト
+        score_threshold: スコアしきい値（信頼度）
+        iou_threshold: 同じクラスの重複ボックスとみなすIoU
+        input_size: モデルへの入力サイズ (width, height)
+        label_map: ラベルID → 文字 の対応表
+        offsets: 切り出し位置 (left, top) のリスト（crop_to_ink を使った場合）
+
+    Returns:
+        results: 画像ごとの {"boxes", "labels", "scores", "tokens"} のリスト
+                 （boxesは元画像の座標、各要素は左から右の順）
+    """
+    num_images = len(outputs)
+    if num_images == 0:
+        return []
+
+    boxes = torch.cat([output["boxes"] for output in outputs])
+    labels = torch.cat([output["labels"] for output in outputs])
+    scores = torch.cat([output["scores"] for output in outputs])
+    counts = torch.tensor([len(output["scores"]) for output in outputs], device=boxes.device)
+    image_idx = torch.repeat_interleave(torch.arange(num_images, device=boxes.device), counts)
+
+    # スコアしきい値
+    keep = scores >= score_threshold
+    boxes, labels, scores, image_idx = boxes[keep], labels[keep], scores[keep], image_idx[keep]
+
+    # 入力サイズ → 元画像サイズへ拡大
+    scale = torch.tensor(
+        [[w / input_size[0], h / input_size[1], w / input_size[0], h / input_size[1]] for w, h in orig_sizes],
+        dtype=boxes.dtype, device=boxes.device
+    )
+    boxes = boxes * scale[image_idx]
+    if offsets is not None:
+        shift = torch.tensor([[x, y, x, y] for x, y in offsets], dtype=boxes.dtype, device=boxes.device)
+        boxes = boxes + shift[image_idx]
+
+    # 画像×クラスごとに重複を除去
+    num_classes = len(label_map) + 1
+    keep = batched_nms(boxes, scores, image_idx * num_classes + labels, iou_threshold)
+    boxes, labels, scores, image_idx = boxes[keep], labels[keep], scores[keep], image_idx[keep]
+
+    # x座標で並べた後、画像ごとにまとめる（安定ソートなので左→右の順が保たれる）
+    order = torch.argsort(boxes[:, 0], stable=True)
+    order = order[torch.argsort(image_idx[order], stable=True)]
+    boxes, labels, scores, image_idx = boxes[order], labels[order], scores[order], image_idx[order]
+
+    split_sizes = torch.bincount(image_idx, minlength=num_images).tolist()
+    results = []
+    for b, l, s in zip(boxes.split(split_sizes), labels.split(split_sizes), scores.split(split_sizes)):
+        results.append({
+            "boxes": b,
+            "labels": l,
+            "scores": s,
+            "tokens": [label_map[label] for label in l.tolist()],
+        })
+    return results
+
+# 数式の字句解析（連続する数字は1つの数値にまとめる）
+def tokenize_formula(tokens):
+    items = []
+    number = ""
+    for token in tokens:
+        if token.isdigit():
+            number += token
+            continue
+        if number:
+            items.append(Fraction(int(number)))
+            number = ""
+        if token not in ('+', '-', '*', '/', '='):
+            raise ValueError(f"使用できない記号です: {token}")
+        items.append(token)
+    if number:
+        items.append(Fraction(int(number)))
+    return items
+
+# 四則演算の構文解析と計算（evalは使わない）
+def parse_expression(items):
+    """
+    expr   := term (('+' | '-') term)*
+    term   := factor (('*' | '/') factor)*
+    factor := '-' factor | 数値
+    """
+    pos = 0
+
+    def peek():
+        return items[pos] if pos < len(items) else None
+
+    def factor():
+        nonlocal pos
+        item = peek()
+        if item == '-':
+            pos += 1
+            return -factor()
+        if isinstance(item, Fraction):
+            pos += 1
+            return item
+        if item is None:
+            raise ValueError("式が途中で終わっています")
+        raise ValueError(f"数値が必要な位置に {item!r} があります")
+
+    def term():
+        nonlocal pos
+        value = factor()
+        while peek() in ('*', '/'):
+            op = items[pos]
+            pos += 1
+            rhs = factor()
+            if op == '*':
+                value *= rhs
+            else:
+                if rhs == 0:
+                    raise ValueError("0で割ることはできません")
+                value /= rhs
+        return value
+
+    def expr():
+        nonlocal pos
+        value = term()
+        while peek() in ('+', '-'):
+            op = items[pos]
+            pos += 1
+            rhs = term()
+            value = value + rhs if op == '+' else value - rhs
+        return value
+
+    if not items:
+        raise ValueError("式が空です")
+    value = expr()
+    if pos != len(items):
+        raise ValueError(f"式の途中に不正な記号があります: {items[pos]!r}")
+    return value
+
+def _to_number(value):
+    """Fractionを整数または小数に変換"""
+    return int(value) if value.denominator == 1 else float(value)
+
+# 読み取った数式を計算し、書かれた答えと照合する
+def evaluate_formula(tokens):
+    """
+    Args:
+        tokens: 左から右に並んだ文字のリスト 例: ['1', '2', '+', '3', '=', '1', '5']
+
+    Returns:
+        result: {"expression", "answer", "written_answer", "is_correct", "error"}
+                （右辺が書かれていない場合は written_answer, is_correct は None）
+    """
+    expression = "".join(tokens)
+    result = {
+        "expression": expression,
+        "answer": None,
+        "written_answer": None,
+        "is_correct": None,
+        "error": None,
+    }
+    try:
+        items = tokenize_formula(tokens)
+        if items.count('=') > 1:
+            raise ValueError("'=' が複数あります")
+        if '=' in items:
+            eq = items.index('=')
+            left, right = items[:eq], items[eq + 1:]
+        else:
+            left, right = items, []
+
+        answer = parse_expression(left)
+        result["answer"] = _to_number(answer)
+        if right:
+            written = parse_expression(right)
+            result["written_answer"] = _to_number(written)
+            result["is_correct"] = written == answer
+    except ValueError as e:
+        result["error"] = str(e)
+    return result
+
+def evaluate_batch(results):
+    """postprocess_detections の結果をまとめて計算"""
+    with metrics.stage("evaluate"):
+        return [evaluate_formula(result["tokens"]) for result in results]
+
+def _empty_result(device):
+    return {
+        "boxes": torch.zeros((0, 4), device=device),
+        "labels": torch.zeros((0,), dtype=torch.int64, device=device),
+        "scores": torch.zeros((0,), device=device),
+        "tokens": [],
+    }
+
+def _run_detector(model, input_tensor, device):
+    """順伝播（SSD内部のNMSを含む）"""
+    with metrics.stage("forward"), torch.no_grad():
+        outputs = model(input_tensor.to(device))
+        if metrics.enabled and torch.device(device).type == "cuda":
+            torch.cuda.synchronize(device)
+    return outputs
+
+def _detect(model, input_tensor, regions, device, score_threshold, input_size):
+    """順伝播と後処理（regions は元の座標での各入力の範囲 (left, top, right, bottom)）"""
+    outputs = _run_detector(model, input_tensor, device)
+    with metrics.stage("postprocess"):
+        return postprocess_detections(
+            outputs, [(x1 - x0, y1 - y0) for x0, y0, x1, y1 in regions], score_threshold=score_threshold,
+            input_size=input_size, offsets=[(x0, y0) for x0, y0, _, _ in regions]
+        )
+
+def _predict_crops(model, crops, device, score_threshold, input_size, start, enqueued_at):
+    """切り出し済みの (画像, 範囲) のリストを推論する（画像が None の入力は空の結果）"""
+    results = [None] * len(crops)
+    indices = [i for i, (image, _) in enumerate(crops) if image is not None]
+    for i, (image, _) in enumerate(crops):
+        if image is None:
+            results[i] = _empty_result(device)
+            metrics.inc("blank_images_total")
+
+    if indices:
+        with metrics.profile():
+            with metrics.stage("resize"):
+                input_tensor = preprocess_batch([crops[i][0] for i in indices], input_size)
+            detections = _detect(
+                model, input_tensor, [crops[i][1] for i in indices], device, score_threshold, input_size
+            )
+        for i, detection in zip(indices, detections):
+            results[i] = detection
+
+    _record_request(results, start, enqueued_at)
+    return results
+
+def _record_request(results, start, enqueued_at):
+    """リクエスト単位の計測（件数・検出数・レイテンシ・待ち時間・RSS）"""
+    if not metrics.enabled:
+        return
+    end = time.perf_counter()
+    metrics.inc("requests_total")
+    metrics.inc("images_total", len(results))
+    metrics.observe("batch_size", len(results), buckets=BATCH_SIZE_BUCKETS)
+    for result in results:
+        metrics.observe("detections_per_image", len(result["tokens"]), buckets=DETECTION_BUCKETS)
+    metrics.observe("request_seconds", end - start)
+    if enqueued_at is not None:
+        metrics.observe("queue_seconds", start - enqueued_at)
+    metrics.record_rss()
+
+# ストロークをまとめて推論する（ストロークのない入力は検出器を通さない）
+def predict_strokes(model, stroke_batch, canvas_sizes, device, score_threshold=0.5,
+                    input_size=(300, 300), line_width=3, enqueued_at=None):
+    """
+    Args:
+        model: SSDモデル
+        stroke_batch: 画像ごとのストロークのリスト（parse_strokes の戻り値）
+        canvas_sizes: 画像ごとのキャンバスサイズ (width, height) のリスト
+        device: 推論に使うデバイス
+        score_threshold: スコアしきい値（信頼度）
+        input_size: モデルへの入力サイズ (width, height)
+        line_width: 入力テンソル上での線の太さ（ピクセル）
+        enqueued_at: リクエストを受け付けた時刻（time.perf_counter() の値、待ち時間の計測用）
+
+    Returns:
+        results: 画像ごとの {"boxes", "labels", "scores", "tokens"} のリスト
+                 （boxesはキャンバスの座標）
+    """
+    if stroke_bounds is None:
+        raise ImportError("src/data/strokes.py が見つかりません（環境変数 STROKES_DIR で場所を指定してください）")
+
+    start = time.perf_counter()
+    results = [None] * len(stroke_batch)
+    # 空のストローク（[[]] など）しかない入力も点がないので空とみなす
+    indices = [i for i, strokes in enumerate(stroke_batch) if stroke_bounds(strokes) is not None]
+    for i, strokes in enumerate(stroke_batch):
+        if stroke_bounds(strokes) is None:
+            results[i] = _empty_result(device)
+            metrics.inc("blank_images_total")
+
+    if indices:
+        with metrics.profile():
+            with metrics.stage("rasterize"):
+                input_tensor, regions = strokes_to_tensor(
+                    [stroke_batch[i] for i in indices], [canvas_sizes[i] for i in indices], input_size, line_width
+                )
+            detections = _detect(model, input_tensor, regions, device, score_threshold, input_size)
+        for i, detection in zip(indices, detections):
+            results[i] = detection
+
+    _record_request(results, start, enqueued_at)
+    return results
+
+# 画像をまとめて推論する（空の入力は検出器を通さない）
+def predict_images(model, images, device, score_threshold=0.5, input_size=(300, 300), crop=True,
+                   enqueued_at=None):
+    """
+    Args:
+        model: SSDモデル
+        images: RGB画像のリスト
+        device: 推論に使うデバイス
+        score_threshold: スコアしきい値（信頼度）
+        input_size: モデルへの入力サイズ (width, height)
+        crop: crop_to_ink でインク部分を切り出すか
+              （渡した画像の解像度で切り出すため、縮小デコードした大きな写真では
+               predict_sources の方が検出器に渡る解像度が高くなる）
+        enqueued_at: リクエストを受け付けた時刻（time.perf_counter() の値、待ち時間の計測用）
+
+    Returns:
+        results: 画像ごとの {"boxes", "labels", "scores", "tokens"} のリスト
+                 （boxesは渡した画像の座標）
+    """
+    start = time.perf_counter()
+    crops = []
+    with metrics.stage("crop"):
+        for image in images:
+            if crop:
+                cropped, offset = crop_to_ink(image)
+                if cropped is None:
+                    crops.append((None, None))
+                    continue
+            else:
+                cropped, offset = image, (0, 0)
+            crops.append((cropped, (offset[0], offset[1], offset[0] + cropped.width, offset[1] + cropped.height)))
+
+    return _predict_crops(model, crops, device, score_threshold, input_size, start, enqueued_at)
+
+# 画像ファイル・バイト列をまとめて推論する（インクはフル解像度から切り出す）
+def predict_sources(model, sources, device, score_threshold=0.5, input_size=(300, 300), enqueued_at=None):
+    """
+    Args:
+        model: SSDモデル
+        sources: 画像のパス、bytes、ファイルオブジェクトのリスト（load_ink_crop を参照）
+        device: 推論に使うデバイス
+        score_threshold: スコアしきい値（信頼度）
+        input_size: モデルへの入力サイズ (width, height)
+        enqueued_at: リクエストを受け付けた時刻（time.perf_counter() の値、待ち時間の計測用）
+
+    Returns:
+        results: 画像ごとの {"boxes", "labels", "scores", "tokens"} のリスト
+                 （boxesは元画像の座標）
+    """
+    start = time.perf_counter()
+    crops = [load_ink_crop(source, input_size) for source in sources]
+    return _predict_crops(model, crops, device, score_threshold, input_size, start, enqueued_at)
+
+model.eval()
+
+image_path = "" # ここに予測したい画像のパスを指定
+orig_image, orig_size = load_image(image_path)
 
 # スコアしきい値（信頼度）を設定
 score_threshold = 0.5
 
+# インクはフル解像度から切り出して推論（空の入力の場合は検出なし）
+result = predict_sources(model, [image_path], device, score_threshold=score_threshold)[0]
+# 元画像の座標 → 描画用に読み込んだ画像の座標
+result["boxes"] = result["boxes"] * (orig_image.width / orig_size[0])
+
+# ====== 7. 描画準備 ======
+draw_image = orig_image.copy()
+draw = ImageDraw.Draw(draw_image)
+
 # フォント（macOS用、必要に応じて変更）
 try:
     font = ImageFont.truetype("Arial.ttf", 32)
@@ -41,33 +866,29 @@ except:
     font = ImageFont.load_default(32)
 
 # ====== 8. 結果の描画 ======
-boxes = output["boxes"]
-labels = output["labels"]
-scores = output["scores"]
-orig_w, orig_h = orig_image.size
-x_scale = orig_w / 300
-y_scale = orig_h / 300
-equation=[]
-for box, label, score in zip(boxes, labels, scores):
-    if score >= score_threshold:
-        x1, y1, x2, y2 = box.tolist()
-        x1 *= x_scale
-        x2 *= x_scale
-        y1 *= y_scale
-        y2 *= y_scale
-        label_name = label_map[int(label)]
-        text = f"{label_name} {score:.2f}"
-        equation.append([x1,label_name])
-        # テキスト位置
-        text_x = x1
-        text_y = y1+10  # 少し上に出す
-        text_size = draw.textlength(text, font=font)
-        # draw.rectangle(
-        #     [text_x, text_y, text_x + text_size, text_y + 35],
-        #     fill="black"  # 背景色を指定
-        # )
-        draw.rectangle([x1, y1, x2, y2], outline="red", width=1)
-        draw.text((x1, y1-30), f"{label_name} {score:.2f}", fill="red", font=font)
+equation = result["tokens"]
+for (x1, y1, x2, y2), label_name, score in zip(result["boxes"].tolist(), equation, result["scores"].tolist()):
+    text = f"{label_name} {score:.2f}"
+    # テキスト位置
+    text_x = x1
+    text_y = y1+10  # 少し上に出す
+    text_size = draw.textlength(text, font=font)
+    # draw.rectangle(
+    #     [text_x, text_y, text_x + text_size, text_y + 35],
+    #     fill="black"  # 背景色を指定
+    # )
+    draw.rectangle([x1, y1, x2, y2], outline="red", width=1)
+    draw.text((x1, y1-30), text, fill="red", font=font)
+
+# ====== 9. 計算結果 ======
+evaluation = evaluate_formula(equation)
+print(f"式: {evaluation['expression']}")
+if evaluation["error"] is not None:
+    print(f"計算できません: {evaluation['error']}")
+else:
+    print(f"答え: {evaluation['answer']}")
+    if evaluation["is_correct"] is not None:
+        print(f"書かれた答え: {evaluation['written_answer']} → {'正解' if evaluation['is_correct'] else '不正解'}")
 plt.figure(figsize=(8, 8))
 plt.imshow(draw_image)
 plt.axis("off")